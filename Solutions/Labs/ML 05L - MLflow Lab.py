@@ -34,6 +34,11 @@
 
 # COMMAND ----------
 
+# The Airbnb dataset is small, so use one shuffle partition per available core instead of the default 200
+spark.conf.set("spark.sql.shuffle.partitions", spark.sparkContext.defaultParallelism)
+
+# COMMAND ----------
+
 # MAGIC %md <i18n value="197ad07c-dead-4444-82de-67353d81dcb0"/>
 # MAGIC 
 # MAGIC 
@@ -88,6 +93,12 @@ test_delta = spark.read.format("delta").option("versionAsOf", data_version).load
 
 # COMMAND ----------
 
+# Cache both tables so the repeated passes made during training don't re-read the Delta files
+train_delta.cache().count()
+test_delta.cache().count()
+
+# COMMAND ----------
+
 # MAGIC %md <i18n value="2bf375c9-fb36-47a3-b973-82fa805e8b22"/>
 # MAGIC 
 # MAGIC 
@@ -119,7 +130,7 @@ display(spark.sql(f"DESCRIBE HISTORY delta.`{train_delta_path}`"))
 # MAGIC 
 # MAGIC ### Step 2. Log initial run to MLflow
 # MAGIC 
-# MAGIC Let's first log a run to MLflow where we use all features. We use the same approach with RFormula as before. This time however, let's also log both the version of our data and the data path to MLflow.
+# MAGIC Let's first log a run to MLflow where we use all features. We one-hot encode the categorical features as before, but fit the feature transformations only once so that later runs can reuse them. This time however, let's also log both the version of our data and the data path to MLflow.
 
 # COMMAND ----------
 
@@ -127,34 +138,47 @@ display(spark.sql(f"DESCRIBE HISTORY delta.`{train_delta_path}`"))
 import mlflow
 import mlflow.spark
 from pyspark.ml.regression import LinearRegression
-from pyspark.ml import Pipeline
-from pyspark.ml.evaluation import RegressionEvaluator
-from pyspark.ml.feature import RFormula
+from pyspark.ml import Pipeline, PipelineModel
+from pyspark.ml.feature import OneHotEncoder, StringIndexer, VectorAssembler
+from pyspark.sql.functions import avg, col, var_pop
+
+def evaluate_regression(pred_df, label_col="price", prediction_col="prediction"):
+    # Compute both metrics from one pass over the predictions, rather than one evaluator pass per metric
+    mse, label_var = pred_df.select(avg((col(label_col) - col(prediction_col)) ** 2), var_pop(label_col)).first()
+    return mse ** 0.5, 1 - mse / label_var
+
+categorical_cols = [field for (field, dataType) in train_delta.dtypes if dataType == "string"]
+index_output_cols = [x + "Index" for x in categorical_cols]
+ohe_output_cols = [x + "OHE" for x in categorical_cols]
+numeric_cols = [field for (field, dataType) in train_delta.dtypes if ((dataType == "double") & (field != "price"))]
+
+string_indexer = StringIndexer(inputCols=categorical_cols, outputCols=index_output_cols, handleInvalid="skip")
+ohe_encoder = OneHotEncoder(inputCols=index_output_cols, outputCols=ohe_output_cols)
+vec_assembler = VectorAssembler(inputCols=ohe_output_cols + numeric_cols, outputCol="features", handleInvalid="skip")
+feature_pipeline_model = Pipeline(stages=[string_indexer, ohe_encoder, vec_assembler]).fit(train_delta)
 
 with mlflow.start_run(run_name="lr_model") as run:
-    # Log parameters
-    mlflow.log_param("label", "price-all-features")
-    mlflow.log_param("data_version", data_version)
-    mlflow.log_param("data_path", train_delta_path)    
+    # Log parameters in a single batch
+    mlflow.log_params({
+        "label": "price-all-features",
+        "data_version": data_version,
+        "data_path": train_delta_path
+    })
 
     # Create pipeline
-    r_formula = RFormula(formula="price ~ .", featuresCol="features", labelCol="price", handleInvalid="skip")
     lr = LinearRegression(labelCol="price", featuresCol="features")
-    pipeline = Pipeline(stages = [r_formula, lr])
-    model = pipeline.fit(train_delta)
+    lr_model = lr.fit(feature_pipeline_model.transform(train_delta))
+    model = PipelineModel(stages=feature_pipeline_model.stages + [lr_model])
 
     # Log pipeline
     mlflow.spark.log_model(model, "model")
 
     # Create predictions and metrics
     pred_df = model.transform(test_delta)
-    regression_evaluator = RegressionEvaluator(labelCol="price", predictionCol="prediction")
-    rmse = regression_evaluator.setMetricName("rmse").evaluate(pred_df)
-    r2 = regression_evaluator.setMetricName("r2").evaluate(pred_df)
+    rmse, r2 = evaluate_regression(pred_df)
 
     # Log metrics
-    mlflow.log_metric("rmse", rmse)
-    mlflow.log_metric("r2", r2)
+    mlflow.log_metrics({"rmse": rmse, "r2": r2})
 
     run_id = run.info.run_id
 
@@ -314,6 +338,8 @@ data_version = 1
 train_delta_new = spark.read.format("delta").option("versionAsOf", data_version).load(train_delta_path)  
 test_delta_new = spark.read.format("delta").option("versionAsOf", data_version).load(test_delta_path)
 
+train_delta_new.cache().count()
+
 # COMMAND ----------
 
 # MAGIC %md <i18n value="f29c99ca-b92c-4f74-8bf5-c74070a8cd50"/>
@@ -328,38 +354,42 @@ test_delta_new = spark.read.format("delta").option("versionAsOf", data_version).
 # COMMAND ----------
 
 with mlflow.start_run(run_name="lr_log_model") as run:
-    # Log parameters
-    mlflow.log_param("label", "log-price")
-    mlflow.log_param("data_version", data_version)
-    mlflow.log_param("data_path", train_delta_path)    
-
-    # Create pipeline
-    r_formula = RFormula(formula="log_price ~ . - price", featuresCol="features", labelCol="log_price", handleInvalid="skip")  
+    # Log parameters in a single batch
+    mlflow.log_params({
+        "label": "log-price",
+        "data_version": data_version,
+        "data_path": train_delta_path
+    })
+
+    # Create pipeline, reusing the feature transformations since the features haven't changed
     lr = LinearRegression(labelCol="log_price", predictionCol="log_prediction")
-    pipeline = Pipeline(stages = [r_formula, lr])
-    pipeline_model = pipeline.fit(train_delta_new)
+    lr_model = lr.fit(feature_pipeline_model.transform(train_delta_new))
+    pipeline_model = PipelineModel(stages=feature_pipeline_model.stages + [lr_model])
 
-    # Log model and update the registered model
+    # Log model, registering it only once we know it performs best
     mlflow.spark.log_model(
         spark_model=pipeline_model,
-        artifact_path="log-model",
-        registered_model_name=model_name
+        artifact_path="log-model"
     )  
 
     # Create predictions and metrics
     pred_df = pipeline_model.transform(test_delta)
     exp_df = pred_df.withColumn("prediction", exp(col("log_prediction")))
-    rmse = regression_evaluator.setMetricName("rmse").evaluate(exp_df)
-    r2 = regression_evaluator.setMetricName("r2").evaluate(exp_df)
+    rmse, r2 = evaluate_regression(exp_df)
 
     # Log metrics
-    mlflow.log_metric("rmse", rmse)
-    mlflow.log_metric("r2", r2)  
+    mlflow.log_metrics({"rmse": rmse, "r2": r2})
 
     run_id = run.info.run_id
 
 # COMMAND ----------
 
+# Both models are trained, so free up the cached tables
+for df in [train_delta, test_delta, train_delta_new]:
+    df.unpersist()
+
+# COMMAND ----------
+
 # MAGIC %md <i18n value="e5bd7bfb-f445-44b5-a272-c6ae2849ac9f"/>
 # MAGIC 
 # MAGIC 
@@ -370,20 +400,28 @@ with mlflow.start_run(run_name="lr_log_model") as run:
 # MAGIC Use MLflow's <a href="https://mlflow.org/docs/latest/python_api/mlflow.html#mlflow.search_runs" target="_blank">**`mlflow.search_runs`**</a> API to identify runs according to the version of data the run was trained on. Let's compare our runs according to our data versions.
 # MAGIC 
 # MAGIC Filter based on **`params.data_path`** and **`params.data_version`**.
+# MAGIC 
+# MAGIC Restrict the search to the experiment of our runs, and pass **`order_by`** and **`max_results`** so the tracking server only returns the best run for each data version.
 
 # COMMAND ----------
 
 # ANSWER
 data_version = 0
 
-mlflow.search_runs(filter_string=f"params.data_path='{train_delta_path}' and params.data_version='{data_version}'")
+mlflow.search_runs(experiment_ids=[run.info.experiment_id],
+                   filter_string=f"params.data_path='{train_delta_path}' and params.data_version='{data_version}'",
+                   order_by=["metrics.rmse ASC"],
+                   max_results=1)
 
 # COMMAND ----------
 
 # ANSWER
 data_version = 1
 
-mlflow.search_runs(filter_string=f"params.data_path='{train_delta_path}' and params.data_version='{data_version}'")
+mlflow.search_runs(experiment_ids=[run.info.experiment_id],
+                   filter_string=f"params.data_path='{train_delta_path}' and params.data_version='{data_version}'",
+                   order_by=["metrics.rmse ASC"],
+                   max_results=1)
 
 # COMMAND ----------
 
@@ -403,12 +441,12 @@ mlflow.search_runs(filter_string=f"params.data_path='{train_delta_path}' and par
 # MAGIC 
 # MAGIC ### Step 7. Move best performing model to production using MLflow model registry
 # MAGIC 
-# MAGIC Get the most recent model version and move it to production.
+# MAGIC Register the **`log_price`** run from Step 5 as a new version of our model and move it to production.
 
 # COMMAND ----------
 
-model_version_infos = client.search_model_versions(f"name = '{model_name}'")
-new_model_version = max([model_version_info.version for model_version_info in model_version_infos])
+new_model_details = mlflow.register_model(model_uri=f"runs:/{run_id}/log-model", name=model_name)
+new_model_version = new_model_details.version
 
 # COMMAND ----------
 
@@ -461,26 +499,18 @@ wait_for_model(model_name, new_model_version, "Production")
 
 # COMMAND ----------
 
-client.transition_model_version_stage(
-    name=model_name,
-    version=1,
-    stage="Archived"
-)
-
-# COMMAND ----------
+from concurrent.futures import ThreadPoolExecutor
 
-wait_for_model(model_name, 1, "Archived")
-
-# COMMAND ----------
-
-client.transition_model_version_stage(
-    name=model_name,
-    version=2,
-    stage="Archived"
-)
+# Both versions can be archived independently, so send the requests concurrently
+with ThreadPoolExecutor(max_workers=2) as executor:
+    futures = [executor.submit(client.transition_model_version_stage, name=model_name, version=version, stage="Archived")
+               for version in [1, 2]]
+    for future in futures:
+        future.result()
 
 # COMMAND ----------
 
+wait_for_model(model_name, 1, "Archived")
 wait_for_model(model_name, 2, "Archived")
 
 # COMMAND ----------
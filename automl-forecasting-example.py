@@ -14,9 +14,10 @@
 # COMMAND ----------
 
 import pyspark.pandas as ps
-df = ps.read_csv("/databricks-datasets/COVID/covid-19-data")
-df["date"] = ps.to_datetime(df['date'], errors='coerce')
-df["cases"] = df["cases"].astype(int)
+# Passing the schema as a DDL string skips the schema inference pass over the CSV files,
+# and reads "date" and "cases" with the types AutoML expects
+schema = "date TIMESTAMP, county STRING, state STRING, fips INT, cases BIGINT, deaths INT"
+df = ps.read_csv("/databricks-datasets/COVID/covid-19-data", names=schema, header=0)
 display(df)
 
 # COMMAND ----------
@@ -30,6 +31,7 @@ display(df)
 # MAGIC - `horizon=30` to specify that AutoML should forecast 30 days into the future. 
 # MAGIC - `frequency="d"` to specify that a forecast should be provided for each day. 
 # MAGIC - `primary_metric="mdape"` to specify the metric to optimize for during training.
+# MAGIC - `timeout_minutes=20` to stop starting new trials after 20 minutes, since the best trial rarely improves much after that.
 
 # COMMAND ----------
 
@@ -40,9 +42,9 @@ import logging
 logging.getLogger("py4j").setLevel(logging.WARNING)
 
 # Note: If you are running Databricks Runtime for Machine Learning 10.4 or below, use this line instead:
-# summary = databricks.automl.forecast(df, target_col="cases", time_col="date", horizon=30, frequency="d",  primary_metric="mdape")
+# summary = databricks.automl.forecast(df, target_col="cases", time_col="date", horizon=30, frequency="d",  primary_metric="mdape", timeout_minutes=20)
 
-summary = databricks.automl.forecast(df, target_col="cases", time_col="date", horizon=30, frequency="d",  primary_metric="mdape", output_database="default")
+summary = databricks.automl.forecast(df, target_col="cases", time_col="date", horizon=30, frequency="d",  primary_metric="mdape", timeout_minutes=20, output_database="default")
 
 # COMMAND ----------
 
@@ -99,15 +101,15 @@ pyfunc_model = mlflow.pyfunc.load_model(model_uri)
 # MAGIC %md ### Use the model to make forecasts
 # MAGIC 
 # MAGIC Call the `predict_timeseries` model method to generate forecasts.    
-# MAGIC In Databricks Runtime for Machine Learning 10.5 or above, you can set `include_history=False` to get the predicted data only.
+# MAGIC The forecasts include the history, which the plot below uses. To get the predicted data only, slice off the dates after the last observed date.
 
 # COMMAND ----------
 
-forecasts = pyfunc_model._model_impl.python_model.predict_timeseries()
-display(forecasts)
+forecasts_full = pyfunc_model._model_impl.python_model.predict_timeseries(include_history=True)
+display(forecasts_full)
 
-# Option for Databricks Runtime for Machine Learning 10.5 or above
-# forecasts = pyfunc_model._model_impl.python_model.predict_timeseries(include_history=False)
+# Predicted data only
+# forecasts_future = forecasts_full[forecasts_full['ds'] > df['date'].max()]
 
 # COMMAND ----------
 
@@ -116,7 +118,11 @@ display(forecasts)
 
 # COMMAND ----------
 
-df_true = df.groupby("date").agg(y=("cases", "avg")).reset_index().to_pandas()
+from pyspark.sql.functions import avg
+
+# Aggregate with Spark and collect the daily averages to the driver as Arrow batches
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+df_true = df.to_spark().groupBy("date").agg(avg("cases").alias("y")).orderBy("date").toPandas()
 
 # COMMAND ----------
 
@@ -124,11 +130,10 @@ import matplotlib.pyplot as plt
 
 fig = plt.figure(facecolor='w', figsize=(10, 6))
 ax = fig.add_subplot(111)
-forecasts = pyfunc_model._model_impl.python_model.predict_timeseries(include_history=True)
-fcst_t = forecasts['ds'].dt.to_pydatetime()
-ax.plot(df_true['date'].dt.to_pydatetime(), df_true['y'], 'k.', label='Observed data points')
-ax.plot(fcst_t, forecasts['yhat'], ls='-', c='#0072B2', label='Forecasts')
-ax.fill_between(fcst_t, forecasts['yhat_lower'], forecasts['yhat_upper'],
+fcst_t = forecasts_full['ds'].to_numpy()
+ax.plot(df_true['date'].to_numpy(), df_true['y'], 'k.', label='Observed data points')
+ax.plot(fcst_t, forecasts_full['yhat'], ls='-', c='#0072B2', label='Forecasts')
+ax.fill_between(fcst_t, forecasts_full['yhat_lower'], forecasts_full['yhat_upper'],
                 color='#0072B2', alpha=0.2, label='Uncertainty interval')
 ax.legend()
 plt.show()